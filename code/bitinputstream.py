@@ -34,6 +34,20 @@ class BitInputStream(object):
 		return result
 	
 	
+	def read_bytes(self, n):
+		result = bytearray()
+		while self.bitbufferlen >= 8 and len(result) < n:
+			result.append(self.read_uint(8))
+		if self.bitbufferlen == 0:
+			result += self.inp.read(n - len(result))
+		else:
+			while len(result) < n:
+				result.append(self.read_uint(8))
+		if len(result) < n:
+			raise EOFError()
+		return bytes(result)
+	
+	
 	def read_signed_int(self, n):
 		temp = self.read_uint(n)
 		temp -= (temp >> (n - 1)) << n
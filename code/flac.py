@@ -1,6 +1,8 @@
+import array
 import crcmod
 import struct
 
+from bitarray.util import ba2int
 from utility import *
 
 BLOCK_SIZE = 4096       # Samples per block
@@ -11,6 +13,9 @@ NUM_CHANNEL = 2
 crc8 = crcmod.predefined.mkPredefinedCrcFun('crc-8')
 crc16 = crcmod.predefined.mkPredefinedCrcFun('crc-16-buypass')
 
+# Tipo di subframe non noto (frame copiati da un altro file)
+SUBFRAME_TYPE_UNKNOWN = 0xFF
+
 class Stream:
     def __init__(self, metadata_blocks, frames):
         self.metadata_blocks = metadata_blocks
@@ -19,7 +24,68 @@ class Stream:
     def get_bytes(self):
         return b'fLaC' + \
                b''.join([block.get_bytes() for block in self.metadata_blocks]) + \
-               b''.join([frame.get_bytes() for frame in self.frames])
+               self.frames.get_bytes()
+
+    def write(self, output_file):
+        output_file.write(b'fLaC')
+        for block in self.metadata_blocks:
+            output_file.write(block.get_bytes())
+        for frame_bytes in self.frames.data:
+            output_file.write(frame_bytes)
+
+class EncodedFrames:
+    # Frame già serializzati: i byte di ogni frame più pochi dati in array tipizzati
+    # (primo campione, numero di campioni, lunghezza in byte, tipo di ogni subframe)
+    __slots__ = ('num_channels', 'data', 'sample_offsets', 'block_sizes', 'byte_lengths', 'subframe_types')
+
+    def __init__(self, num_channels):
+        self.num_channels = num_channels
+        self.data = list()
+        self.sample_offsets = array.array('Q')
+        self.block_sizes = array.array('I')
+        self.byte_lengths = array.array('I')
+        self.subframe_types = array.array('B')
+
+    def __len__(self):
+        return len(self.data)
+
+    def append(self, sample_offset, frame):
+        # Il frame viene serializzato subito: da qui in poi non serve più l'albero di oggetti
+        frame_bytes = frame.get_bytes()
+
+        self.data.append(frame_bytes)
+        self.sample_offsets.append(sample_offset)
+        self.block_sizes.append(frame.num_samples)
+        self.byte_lengths.append(len(frame_bytes))
+
+        # Dei frame copiati da un altro file non conosco il tipo dei subframe
+        subframe_types = frame.get_subframe_types()
+        if subframe_types is None:
+            subframe_types = [SUBFRAME_TYPE_UNKNOWN] * self.num_channels
+        self.subframe_types.extend(subframe_types)
+
+    def get_bytes(self):
+        return b''.join(self.data)
+
+    def min_frame_size(self):
+        return min(self.byte_lengths) if self.byte_lengths else 0
+
+    def max_frame_size(self):
+        return max(self.byte_lengths) if self.byte_lengths else 0
+
+    def seek_points(self, interval):
+        # Un seek point (primo campione, offset dal primo frame, campioni) ogni 'interval' campioni
+        seek_points = list()
+        byte_offset = 0
+        next_sample = 0
+
+        for sample_offset, block_size, byte_length in zip(self.sample_offsets, self.block_sizes, self.byte_lengths):
+            if sample_offset + block_size > next_sample:
+                seek_points.append((sample_offset, byte_offset, block_size))
+                next_sample = ((sample_offset + block_size - 1) // interval + 1) * interval
+            byte_offset += byte_length
+
+        return seek_points
 
 class MetadataBlock:
     def __init__(self, metadata_block_header, metadata_block_data):
@@ -46,17 +112,19 @@ class MetadataBlockHeader:
         return bits.tobytes()
 
 class MetadataBlockStreamInfo:
-    def __init__(self, num_samples, md5_digest):
+    def __init__(self, num_samples, md5_digest, min_frame_size=0, max_frame_size=0):
         self.num_samples = num_samples
         self.md5_digest = md5_digest
+        self.min_frame_size = min_frame_size
+        self.max_frame_size = max_frame_size
 
     def get_bytes(self):
         bits = bitarray(144)
 
         bits[0:16] = bitarray_from_int(BLOCK_SIZE, 16)
         bits[16:32] = bitarray_from_int(BLOCK_SIZE, 16)
-        bits[32:56] = 0
-        bits[56:80] = 0
+        bits[32:56] = bitarray_from_int(self.min_frame_size, 24)
+        bits[56:80] = bitarray_from_int(self.max_frame_size, 24)
         bits[80:100] = bitarray_from_int(SAMPLE_RATE, 20)
         bits[100:103] = bitarray_from_int(NUM_CHANNEL-1, 3)
         bits[103:108] = bitarray_from_int(SAMPLE_SIZE-1, 5)
@@ -64,6 +132,22 @@ class MetadataBlockStreamInfo:
 
         return bits.tobytes() + self.md5_digest
 
+class MetadataBlockSeekTable:
+    def __init__(self, seek_points):
+        self.seek_points = seek_points
+
+    def get_bytes(self):
+        # Ogni seek point: primo campione (64 bit), offset dal primo frame (64 bit), numero di campioni (16 bit)
+        return b''.join([struct.pack('>QQH', *seek_point) for seek_point in self.seek_points])
+
+class MetadataBlockApplication:
+    def __init__(self, application_id, data):
+        self.application_id = application_id
+        self.data = data
+
+    def get_bytes(self):
+        return self.application_id + self.data
+
 class Frame:
     def __init__(self, frame_number, num_samples, subframes):
         self.frame_number = frame_number
@@ -95,6 +179,9 @@ class Frame:
         crc_bytes = bytes((crc8(crc_input),))
 
         return crc_input + crc_bytes
+
+    def get_subframe_types(self):
+        return [subframe.get_type() for subframe in self.subframes]
     
     def get_subframe_and_padding_bytes(self):
         subframe_bits = sum([subframe.get_bits() for subframe in self.subframes], bitarray())
@@ -120,6 +207,45 @@ class Frame:
                self.get_subframe_and_padding_bytes() + \
                self.get_footer_bytes()
 
+class CopiedFrame:
+    # Frame già codificato preso da un file flac precedente
+    def __init__(self, frame_number, num_samples, frame_bytes, header_length):
+        self.frame_number = frame_number
+        self.num_samples = num_samples
+        self.frame_bytes = frame_bytes
+        self.header_length = header_length
+
+    def get_bytes(self):
+        # Il numero del frame (utf-8) parte dal quinto byte dell'header:
+        # la sua lunghezza è data dagli 1 iniziali del primo byte
+        number_start = 4
+        number_end = number_start + 1
+        temp = self.frame_bytes[number_start]
+        if temp >= 0b11000000:
+            while temp & 0x40:
+                number_end += 1
+                temp = (temp << 1) & 0xFF
+
+        frame_number_bytes = utf8_encoded_bitarray_from_int(self.frame_number).tobytes()
+
+        # Se il numero del frame non è cambiato lo copio così com'è
+        if frame_number_bytes == self.frame_bytes[number_start:number_end]:
+            return self.frame_bytes
+
+        # Altrimenti sostituisco solo il numero del frame, mantenendo il resto dell'header
+        # (channel assignment, codici di blocksize/samplerate, ...), e ricalcolo i CRC
+        header_bytes = self.frame_bytes[:number_start] + frame_number_bytes + \
+                       self.frame_bytes[number_end:self.header_length - 1]
+        header_bytes += bytes((crc8(header_bytes),))
+
+        crc_input = header_bytes + self.frame_bytes[self.header_length:-2]
+        crc_bytes = struct.pack('>H', crc16(crc_input))
+
+        return crc_input + crc_bytes
+
+    def get_subframe_types(self):
+        return None
+
 class Subframe:
     def __init__(self):
         # Subframe è composta da header e data
@@ -136,6 +262,10 @@ class Subframe:
     def get_bits(self):
         return self.header_bits + self.data_bits
 
+    def get_type(self):
+        # 6 bit del tipo di subframe (000000 constant, 000001 verbatim, 001xxx fixed, ...)
+        return ba2int(self.header_bits[1:7])
+
 class SubframeConstant(Subframe):
     def __init__(self, constant):
         super().__init__()
@@ -1,5 +1,9 @@
+import array
+import contextlib
+import os
 import struct
 import sys
+import numpy as np
 from bitinputstream import BitInputStream
 
 FIXED_PREDICTION_COEFFICIENTS = (
@@ -18,6 +22,13 @@ def main(argv):
             decode(inp, out)
 
 def decode(inp, out):
+    # Leggo i metadati e creo il flusso da decodificare
+    stream = read_stream_info(inp)
+
+    # Chiamo la funzione write che decodifica il flusso e scrive il nuovo file
+    write_stream(inp, stream, out)
+
+def read_stream_info(inp):
     # Leggo il file flac e verifico che i primi 32 bit siano coerenti con il formato flac
     if inp.read_uint(32) != 0x664C6143:
         raise ValueError("Invalid fLaC file!")
@@ -33,7 +44,7 @@ def decode(inp, out):
         length = inp.read_uint(24)
         if typo == 0:
             inp.read_uint(16)
-            inp.read_uint(16)
+            maxblocksize = inp.read_uint(16)
             inp.read_uint(24)
             inp.read_uint(24)
             samplerate = inp.read_uint(20)
@@ -42,8 +53,7 @@ def decode(inp, out):
             numsamples = inp.read_uint(36)
             inp.read_uint(128)
         else:
-            for i in range(length):
-                inp.read_uint(8)
+            inp.read_bytes(length)
     
     # Verifico che il samplerate non sia nullo
     if samplerate is None:
@@ -53,11 +63,66 @@ def decode(inp, out):
     if samplesize % 8 != 0:
         raise RuntimeError("Sample size not supported!")
     
-    # Creo il flusso da decodificare 
-    stream = WaveStream(samplesize, samplerate, numchannels, numsamples)
+    return WaveStream(samplesize, samplerate, numchannels, numsamples, maxblocksize)
 
-    # Chiamo la funzione write che decodifica il flusso e scrive il nuovo file
-    write_stream(inp, stream, out)
+def iter_frames(source, copy=True):
+    # Decodifica un file flac (path o file object) senza scrivere il WAV:
+    # restituisce coppie (primo campione del frame, ndarray[blocksize, numchannels]).
+    # Con copy=False l'ndarray è una vista in sola lettura sui buffer del decoder,
+    # valida solo fino al frame successivo (che la sovrascrive): va copiata per conservarla
+    with open_bit_input_stream(source) as inp:
+        stream = read_stream_info(inp)
+        for first_sample, block in iter_stream_frames(inp, stream):
+            yield first_sample, block.copy() if copy else block
+
+def read_all(source):
+    # Decodifica l'intero file in un array preallocato di dimensione
+    # [numsamples, numchannels] usando il numero di campioni di STREAMINFO
+    with open_bit_input_stream(source) as inp:
+        stream = read_stream_info(inp)
+
+        # numsamples == 0 significa "sconosciuto": concateno i blocchi
+        if stream.num_samples == 0:
+            blocks = [block.copy() for _, block in iter_stream_frames(inp, stream)]
+            if not blocks:
+                return np.empty((0, stream.num_channels), dtype=np.int32)
+            return np.concatenate(blocks)
+
+        result = np.empty((stream.num_samples, stream.num_channels), dtype=np.int32)
+        num_decoded = 0
+        for first_sample, block in iter_stream_frames(inp, stream):
+            if first_sample + len(block) > stream.num_samples:
+                raise ValueError("More samples than declared in stream info!")
+            result[first_sample : first_sample + len(block)] = block
+            num_decoded = max(num_decoded, first_sample + len(block))
+
+        # Un file troncato lascerebbe la coda dell'array non inizializzata
+        if num_decoded < stream.num_samples:
+            raise ValueError("Fewer samples than declared in stream info!")
+        return result
+
+@contextlib.contextmanager
+def open_bit_input_stream(source):
+    # Se ricevo un path apro (e poi chiudo) il file, altrimenti uso il file object
+    # così com'è lasciandone la chiusura al chiamante
+    if isinstance(source, (str, bytes, os.PathLike)):
+        with BitInputStream(open(source, "rb")) as inp:
+            yield inp
+    else:
+        yield BitInputStream(source)
+
+def iter_stream_frames(inp, stream, buffers=None):
+    # Tutti i frame vengono decodificati negli stessi buffer
+    if buffers is None:
+        buffers = FrameBuffers(stream)
+
+    first_sample = 0
+    while True:
+        blocksize = decode_frame(inp, stream.sample_size, buffers)
+        if blocksize is None:
+            return
+        yield first_sample, buffers.get_block(blocksize)
+        first_sample += blocksize
 
 def write_stream(inp, stream, out):
     # Scrivo l'header del file WAV
@@ -72,14 +137,26 @@ def write_stream(inp, stream, out):
     out.write(b"data")
     out.write(struct.pack("<I", sampledatalen))
 
-    # Decodifico tutti i frames
-    while decode_frame(inp, stream.num_channels, stream.sample_size, out):
-        pass
+    # Decodifico tutti i frames e scrivo i campioni
+    buffers = FrameBuffers(stream)
+    for _, block in iter_stream_frames(inp, stream, buffers):
+        write_samples(block, stream.sample_size, buffers, out)
 
-def decode_frame(inp, num_channels, sample_size, out):
+def write_samples(block, sample_size, buffers, out):
+    # Campioni interleaved little-endian su sample_size // 8 byte (8 bit --> unsigned)
+    numbytes = sample_size // 8
+    addend = 128 if sample_size == 8 else 0
+    blocksize = len(block)
+    wide = buffers.wide[:blocksize]
+    pcm = buffers.pcm[:blocksize]
+    np.add(block, addend, out=wide, casting="unsafe")
+    np.copyto(pcm, wide.view(np.uint8).reshape(blocksize, -1, 4)[:, :, :numbytes])
+    out.write(pcm.data)
+
+def decode_frame(inp, sample_size, buffers):
     temp = inp.read_byte()
     if temp == -1:
-        return False
+        return None
     sync = temp << 6 | inp.read_uint(6)
     if sync != 0x3FFE:
         raise ValueError("Sync code expected!")
@@ -115,25 +192,29 @@ def decode_frame(inp, num_channels, sample_size, out):
 
     inp.read_uint(8)
 
-    # Decode each channel's subframe, then skip footer
-    samples = decode_subframes(inp, blocksize, sample_size, chanasgn)
+    if blocksize > buffers.max_block_size:
+        raise ValueError("Block size larger than stream info maximum!")
+
+    # Decode each channel's subframe into the buffers, then skip footer
+    decode_subframes(inp, blocksize, sample_size, chanasgn, buffers.channels)
     inp.align_to_byte()
     inp.read_uint(16)
 
-    # Write the decoded samples
-    numbytes = sample_size // 8
-    addend = 128 if sample_size == 8 else 0
-    for i in range(blocksize):
-        for j in range(num_channels):
-            out.write(struct.pack("<i", samples[j][i] + addend)[ : numbytes])
-    return True
+    return blocksize
 
-def decode_subframes(inp, blocksize, sample_size, chanasgn):
+def decode_subframes(inp, blocksize, sample_size, chanasgn, channels):
     if 0 <= chanasgn <= 7:
-        return [decode_subframe(inp, blocksize, sample_size) for _ in range(chanasgn + 1)]
+        if chanasgn >= len(channels):
+            raise ValueError("Channel assignment does not match stream info")
+        for j in range(chanasgn + 1):
+            decode_subframe(inp, blocksize, sample_size, channels[j])
     elif 8 <= chanasgn <= 10:
-        temp0 = decode_subframe(inp, blocksize, sample_size + (1 if (chanasgn == 9) else 0))
-        temp1 = decode_subframe(inp, blocksize, sample_size + (0 if (chanasgn == 9) else 1))
+        if len(channels) != 2:
+            raise ValueError("Channel assignment does not match stream info")
+        temp0 = channels[0]
+        temp1 = channels[1]
+        decode_subframe(inp, blocksize, sample_size + (1 if (chanasgn == 9) else 0), temp0)
+        decode_subframe(inp, blocksize, sample_size + (0 if (chanasgn == 9) else 1), temp1)
         if chanasgn == 8:
             for i in range(blocksize):
                 temp1[i] = temp0[i] - temp1[i]
@@ -146,11 +227,10 @@ def decode_subframes(inp, blocksize, sample_size, chanasgn):
                 right = temp0[i] - (side >> 1)
                 temp1[i] = right
                 temp0[i] = right + side
-        return [temp0, temp1]
     else:
         raise ValueError("Reserved channel assignment")
 
-def decode_subframe(inp, blocksize, sample_size):
+def decode_subframe(inp, blocksize, sample_size, result):
     inp.read_uint(1)
     type = inp.read_uint(6)
     shift = inp.read_uint(1)
@@ -160,24 +240,42 @@ def decode_subframe(inp, blocksize, sample_size):
     sample_size -= shift
 
     if type == 0:  # Constant coding
-        result = [inp.read_signed_int(sample_size)] * blocksize
+        temp = inp.read_signed_int(sample_size)
+        for i in range(blocksize):
+            result[i] = temp
     elif type == 1:  # Verbatim coding
-        result = [inp.read_signed_int(sample_size) for _ in range(blocksize)]
+        for i in range(blocksize):
+            result[i] = inp.read_signed_int(sample_size)
     elif 8 <= type <= 12:
-        result = decode_fixed_prediction_subframe(inp, type - 8, blocksize, sample_size)
+        decode_fixed_prediction_subframe(inp, type - 8, blocksize, sample_size, result)
     elif 32 <= type <= 63:
-        result = decode_linear_predictive_coding_subframe(inp, type - 31, blocksize, sample_size)
+        decode_linear_predictive_coding_subframe(inp, type - 31, blocksize, sample_size, result)
     else:
         raise ValueError("Reserved subframe type")
-    return [(v << shift) for v in result]
+    if shift > 0:
+        for i in range(blocksize):
+            result[i] <<= shift
+
+def decode_fixed_prediction_subframe(inp, predorder, blocksize, sample_size, result):
+    for i in range(predorder):
+        result[i] = inp.read_signed_int(sample_size)
+    decode_residuals(inp, blocksize, predorder, result)
+    restore_linear_prediction(result, blocksize, FIXED_PREDICTION_COEFFICIENTS[predorder], 0)
 
-def decode_fixed_prediction_subframe(inp, predorder, blocksize, sample_size):
-    result = [inp.read_signed_int(sample_size) for _ in range(predorder)]
-    decode_residuals(inp, blocksize, result)
-    restore_linear_prediction(result, FIXED_PREDICTION_COEFFICIENTS[predorder], 0)
-    return result
+def decode_linear_predictive_coding_subframe(inp, lpcorder, blocksize, sample_size, result):
+    for i in range(lpcorder):
+        result[i] = inp.read_signed_int(sample_size)
+    precision = inp.read_uint(4) + 1
+    if precision == 16:
+        raise ValueError("Invalid LPC coefficient precision")
+    shift = inp.read_signed_int(5)
+    if shift < 0:
+        raise ValueError("Invalid LPC shift")
+    coefs = [inp.read_signed_int(precision) for _ in range(lpcorder)]
+    decode_residuals(inp, blocksize, lpcorder, result)
+    restore_linear_prediction(result, blocksize, coefs, shift)
 
-def decode_residuals(inp, blocksize, result):
+def decode_residuals(inp, blocksize, warmup, result):
     method = inp.read_uint(2)
     if method >= 2:
         raise ValueError("Reserved residual coding method")
@@ -189,27 +287,54 @@ def decode_residuals(inp, blocksize, result):
     if blocksize % numpartitions != 0:
         raise ValueError("Block size not divisible by number of Rice partitions")
 
+    start = warmup
     for i in range(numpartitions):
-        count = blocksize >> partitionorder
-        if i == 0:
-            count -= len(result)
+        end = (i + 1) * (blocksize >> partitionorder)
         param = inp.read_uint(parambits)
         if param < escapeparam:
-            result.extend(inp.read_rice_signed_int(param) for _ in range(count))
+            for j in range(start, end):
+                result[j] = inp.read_rice_signed_int(param)
         else:
             numbits = inp.read_uint(5)
-            result.extend(inp.read_signed_int(numbits) for _ in range(count))
+            for j in range(start, end):
+                result[j] = inp.read_signed_int(numbits)
+        start = end
 
-def restore_linear_prediction(result, coefs, shift):
-    for i in range(len(coefs), len(result)):
+def restore_linear_prediction(result, blocksize, coefs, shift):
+    for i in range(len(coefs), blocksize):
         result[i] += sum((result[i - 1 - j] * c) for (j, c) in enumerate(coefs)) >> shift
 
+class FrameBuffers:
+    # Buffer per canale dimensionati sul blocksize massimo di STREAMINFO e riusati per ogni frame.
+    # I canali sono viste (memoryview) su un unico array, che numpy vede come matrice
+    # [numchannels, maxblocksize] senza copie
+    def __init__(self, stream):
+        self.max_block_size = stream.max_block_size
+        # int32 basta fino a 24 bit (+1 per il canale side), altrimenti int64
+        typecode, dtype = ("i", np.int32) if stream.sample_size <= 24 else ("q", np.int64)
+
+        self.samples = array.array(typecode, bytes(np.dtype(dtype).itemsize * stream.num_channels * self.max_block_size))
+        view = memoryview(self.samples)
+        self.channels = [view[j * self.max_block_size : (j + 1) * self.max_block_size] for j in range(stream.num_channels)]
+        self.matrix = np.frombuffer(self.samples, dtype=dtype).reshape(stream.num_channels, self.max_block_size)
+
+        # Buffer per la scrittura del WAV
+        self.wide = np.empty((self.max_block_size, stream.num_channels), dtype="<i4")
+        self.pcm = np.empty((self.max_block_size, stream.num_channels, stream.sample_size // 8), dtype=np.uint8)
+
+    def get_block(self, blocksize):
+        # Vista [blocksize, numchannels] in sola lettura sui primi blocksize campioni di ogni canale
+        block = self.matrix[:, :blocksize].T
+        block.setflags(write=False)
+        return block
+
 class WaveStream:
-    def __init__(self, sample_size, sample_rate, num_channels, num_samples):
+    def __init__(self, sample_size, sample_rate, num_channels, num_samples, max_block_size):
         self.sample_size = sample_size
         self.sample_rate = sample_rate
         self.num_channels = num_channels
         self.num_samples = num_samples
+        self.max_block_size = max_block_size
 
 if __name__ == "__main__":
     main(sys.argv)
\ No newline at end of file
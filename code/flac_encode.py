@@ -1,10 +1,11 @@
 import sys
-import wave
 import hashlib
 import math
-import array
 import numpy as np 
 from flac import *
+from flac_decode import iter_frames
+from flac_info import read_metadata, build_frame_index, parse_frame_header
+from wavefile import WaveFile
 
 BLOCK_SIZE = 4096       # Samples per block
 SAMPLE_RATE = 44100     # Hz
@@ -13,11 +14,11 @@ NUM_CHANNEL = 2
 
 MAX_FIXED_PREDICTOR_ORDER = 4
 
-# Tipologie di blocco Flac (uso solo streaminfo)
+# Tipologie di blocco Flac (uso streaminfo, seektable e application)
 BLOCK_TYPE_STREAMINFO = 0
 #BLOCK_TYPE_PADDING = 1
-#BLOCK_TYPE_APPLICATION = 2
-#BLOCK_TYPE_SEEKTABLE = 3
+BLOCK_TYPE_APPLICATION = 2
+BLOCK_TYPE_SEEKTABLE = 3
 #BLOCK_TYPE_VORBIS_COMMENT = 4
 #BLOCK_TYPE_CUESHEET = 5
 #BLOCK_TYPE_PICTURE = 6
@@ -26,115 +27,136 @@ BLOCK_TYPE_STREAMINFO = 0
 #RESIDUAL_CODING_METHOD_PARTITION_RICE = 0
 RESIDUAL_CODING_METHOD_PARTITION_RICE2 = 1
 
+# Blocco APPLICATION con l'MD5 del PCM di ogni blocco (usato per la codifica incrementale)
+APPLICATION_ID_BLOCK_HASHES = b'blkh'
+BLOCK_HASH_SIZE = 16
+MAX_METADATA_BLOCK_LENGTH = (1 << 24) - 1
+
+# Un seek point ogni 10 secondi
+SEEK_POINT_INTERVAL = 10 * SAMPLE_RATE
+
 def main(argv):
     # Leggo il file di input e creo il flusso da codificare
-    wave_stream = read_wave(argv[1])
-    # Codifico il flusso di input e restituisco il nuovo flusso
-    stream = encode_wave_stream(wave_stream)
+    with read_wave(argv[1]) as wave_stream:
+        # Codifico il flusso di input e restituisco il nuovo flusso
+        # (se mi viene passato il flac precedente riuso i frame che non sono cambiati)
+        if len(argv) > 3:
+            with PreviousStream(argv[3]) as previous_stream:
+                stream = encode_wave_stream(wave_stream, previous_stream)
+        else:
+            stream = encode_wave_stream(wave_stream)
     # Scrivo il file flac
     write_stream(stream, argv[2])
 
 def read_wave(input_path):
-    # Apro il file wav
-    input_file = wave.open(input_path, 'rb')
-
-    # Bits per sample
-    sample_size = input_file.getsampwidth() * 8
-    # Frame rate
-    sample_rate = input_file.getframerate()
-    # Numero di canali
-    num_channels = input_file.getnchannels()
-    # Numero di frames
-    num_samples = input_file.getnframes()
-    # Numero frames totali
-    num_interleaved_samples = num_channels * num_samples
-
-    # Restrizioni al tipo di file di input
-    assert sample_size == SAMPLE_SIZE, "Only 16 bit"
-    assert sample_rate == SAMPLE_RATE, "Only 44.1 Hz"
-    assert num_channels == NUM_CHANNEL, "Only stereo input"
-
-    # Frames (stringa)
-    raw_frames = input_file.readframes(num_samples)
-
-    # Chiudo il file
-    input_file.close()
-
-    # MD5
-    md5_digest = hashlib.md5(raw_frames).digest()
-
-    # "Estraggo" i valori numerici dei campioni
-    # Gli indici pari contengono i valori del primo canale
-    # Gli indici dispari quelli del secondo
-    # '<' --> little-endian, 'h' --> short int
-    interleaved_samples = struct.unpack('<' + str(num_interleaved_samples) + 'h', raw_frames)
-
-    # Creo una lista contenente tante liste quanti sono i canali    
-    channels = [list() for i in range(num_channels)]
-
-    # Metto ogni campione nella lista giusta (pari -> primo canale, dispari -> secondo canale)
-    for index, sample in enumerate(interleaved_samples):
-        channels[index % num_channels].append(sample)
+    # Apro il file wav (RIFF o RF64) mappandolo in memoria
+    input_file = WaveFile(input_path)
+
+    try:
+        # Restrizioni al tipo di file di input
+        assert input_file.sample_size == SAMPLE_SIZE, "Only 16 bit"
+        assert input_file.sample_rate == SAMPLE_RATE, "Only 44.1 Hz"
+        assert input_file.num_channels == NUM_CHANNEL, "Only stereo input"
+
+        # MD5 calcolato direttamente sulla regione mappata
+        md5_digest = input_file.get_md5_digest()
+
+        # Matrice [numsamples, numchannels] sui campioni del file (nessuna copia):
+        # ogni canale è la vista su una colonna
+        samples = input_file.get_samples()
+        channels = [samples[:, i] for i in range(input_file.num_channels)]
+    except BaseException:
+        input_file.close()
+        raise
 
     # Creo il flusso da codificare utilizzando la classe WaveStream
-    wave_stream = WaveStream(sample_rate, (sample_size/8), [array.array('h', channel) for channel in channels], md5_digest)
+    # (il flusso tiene aperto il file mappato finché non viene chiuso)
+    wave_stream = WaveStream(input_file.sample_size, input_file.sample_rate, channels, md5_digest, input_file)
     
     return wave_stream
 
-def encode_wave_stream(wave_stream):
-    # Inizializzo la lista dei frames
-    frames = list()
+def encode_wave_stream(wave_stream, previous_stream=None):
+    # Inizializzo la lista dei frames (ogni frame viene serializzato appena codificato)
+    frames = EncodedFrames(wave_stream.num_channels)
+    block_hashes = list()
 
     # Creo il mio nuovo flusso
     for sample_index in range(0, wave_stream.num_samples, BLOCK_SIZE):
         # Ogni frame ha dimensione "BLOCK_SIZE" quindi ogni frame avrà questo "indice":
         frame_number = sample_index // BLOCK_SIZE
+        # Calcolo il numero di campioni nel frame
+        num_samples_in_frame = (wave_stream.num_samples - sample_index) if (wave_stream.num_samples - sample_index) < BLOCK_SIZE else BLOCK_SIZE
+
+        # Campioni del blocco per ogni canale (viste sul file di input)
+        block = [channel[sample_index : sample_index + BLOCK_SIZE] for channel in wave_stream.channels]
+
+        block_hash = hash_block(block)
+        block_hashes.append(block_hash)
+
+        # Se il blocco era già presente nel flac precedente riuso il frame codificato
+        if previous_stream is not None:
+            copied_frame = previous_stream.copy_frame(block_hash, frame_number, num_samples_in_frame)
+            if copied_frame is not None:
+                frames.append(sample_index, copied_frame)
+                continue
+
         # Inizializzo lista dei subframes
         subframes = list()
 
         # Flac ha quattro tipi di subframes (ne implemento 3):
-        for channel in wave_stream.channels:
+        for signal in block:
+            # Copio in una lista di int solo i campioni del blocco corrente
+            signal = signal.tolist()
             subframe_candidates = list()
 
             # Constant
-            subframe_candidates.append(make_subframe_constant(channel, sample_index))
+            subframe_candidates.append(make_subframe_constant(signal))
             # Verbatim
-            subframe_candidates.append(make_subframe_verbatim(channel, sample_index))
+            subframe_candidates.append(make_subframe_verbatim(signal))
             # Fixed
             for fixed_predictor_order in range(MAX_FIXED_PREDICTOR_ORDER + 1):
-                subframe_candidates.append(make_subframe_fixed(channel, sample_index, fixed_predictor_order))
+                subframe_candidates.append(make_subframe_fixed(signal, fixed_predictor_order))
 
             subframe_candidates = filter(None, subframe_candidates)
             smallest_subframe = min(subframe_candidates, key=len)
             # Conserverò solamente quello più piccolo
             subframes.append(smallest_subframe)
 
-        # Calcolo il numero di campioni nel frame
-        num_samples_in_frame = (wave_stream.num_samples - sample_index) if (wave_stream.num_samples - sample_index) < BLOCK_SIZE else BLOCK_SIZE
-
         # Creo il nuovo frame
         frame = Frame(frame_number, num_samples_in_frame, subframes)
 
         # Lo aggiungo alla lista dei frame
-        frames.append(frame)
+        frames.append(sample_index, frame)
 
     # Aggiungo il blocco di metadati riguardanti le info sul flusso
-    metadata_block_stream_info = MetadataBlockStreamInfo(wave_stream.num_samples, wave_stream.md5_digest)
-    # Aggiungo l'header
-    metadata_block_header = MetadataBlockHeader(True, BLOCK_TYPE_STREAMINFO, len(metadata_block_stream_info.get_bytes()))
-    # Costruisco il blocco "Metadati" in generale composto da header + stream info
-    metadata_block = MetadataBlock(metadata_block_header, metadata_block_stream_info)
-    
-    metadata_blocks = (metadata_block, )
+    metadata_block_data = [(BLOCK_TYPE_STREAMINFO, MetadataBlockStreamInfo(wave_stream.num_samples, wave_stream.md5_digest,
+                                                                           frames.min_frame_size(), frames.max_frame_size()))]
+    # Seek table ricavata dagli offset dei frame
+    metadata_block_data.append((BLOCK_TYPE_SEEKTABLE, MetadataBlockSeekTable(frames.seek_points(SEEK_POINT_INTERVAL))))
+    # Blocco con gli hash dei blocchi PCM (omesso se supera la lunghezza massima di un blocco)
+    metadata_block_application = MetadataBlockApplication(APPLICATION_ID_BLOCK_HASHES, b''.join(block_hashes))
+    if len(metadata_block_application.get_bytes()) <= MAX_METADATA_BLOCK_LENGTH:
+        metadata_block_data.append((BLOCK_TYPE_APPLICATION, metadata_block_application))
+
+    # Costruisco i blocchi "Metadati" composti da header + dati (solo l'ultimo ha il bit "last")
+    metadata_blocks = list()
+    for i, (block_type, block_data) in enumerate(metadata_block_data):
+        metadata_block_header = MetadataBlockHeader(i == len(metadata_block_data) - 1, block_type, len(block_data.get_bytes()))
+        metadata_blocks.append(MetadataBlock(metadata_block_header, block_data))
     
     # Creo il nuovo flusso
     stream = Stream(metadata_blocks, frames)
 
     return stream
 
-def make_subframe_constant(channel, sample_index):
-    # Frame
-    signal = channel[sample_index : sample_index + BLOCK_SIZE]
+def hash_block(channel_signals):
+    # MD5 dei campioni (16 bit little-endian) di ogni canale del blocco
+    md5 = hashlib.md5()
+    for signal in channel_signals:
+        md5.update(signal.astype('<i2').tobytes())
+    return md5.digest()
+
+def make_subframe_constant(signal):
     # Primo campione
     first_sample = signal[0]
 
@@ -146,9 +168,7 @@ def make_subframe_constant(channel, sample_index):
     # Costruisci una subframe constant
     return SubframeConstant(first_sample)
 
-def make_subframe_verbatim(channel, sample_index):
-    signal = channel[sample_index : sample_index + BLOCK_SIZE]
-
+def make_subframe_verbatim(signal):
     return SubframeVerbatim(signal)
 
 def fixed_predictor_residual_signal(signal, order):
@@ -182,13 +202,11 @@ def rice_parameter(residual_signal):
     # Calcolo del rice parameter
     return math.ceil(math.log2(ln_2 * e_x)) if e_x > 0.0 else 0
 
-def make_subframe_fixed(channel, sample_index, predictor_order):
-    # Frame
-    signal = channel[sample_index : sample_index + BLOCK_SIZE]
+def make_subframe_fixed(signal, predictor_order):
     # Campioni che non passo al predittore
-    warmup_samples = channel[sample_index : sample_index + predictor_order]
+    warmup_samples = signal[:predictor_order]
 
-    if len(signal) <= predictor_order or len(warmup_samples) < predictor_order:
+    if len(signal) <= predictor_order:
         return None
 
     # Calcolo del residual signal
@@ -205,16 +223,106 @@ def make_subframe_fixed(channel, sample_index, predictor_order):
 
 def write_stream(stream, output_path):
     with open(output_path, 'wb') as output_file:
-        output_file.write(stream.get_bytes())
+        stream.write(output_file)
+
+class PreviousStream:
+    # File flac codificato in precedenza da cui copiare i frame non modificati
+    def __init__(self, input_path):
+        self.input_file = open(input_path, 'rb')
+        self.frames = dict()
+
+        # Se la lettura dell'indice fallisce non devo lasciare il file aperto
+        try:
+            self.read_frames()
+        except BaseException:
+            self.input_file.close()
+            raise
+
+    def read_frames(self):
+        metadata = read_metadata(self.input_file)
+        stream_info = metadata.stream_info
+
+        # Riuso i frame solo se il formato coincide con quello che codifico
+        if (stream_info.sample_rate, stream_info.num_channels, stream_info.sample_size, stream_info.max_block_size) != \
+           (SAMPLE_RATE, NUM_CHANNEL, SAMPLE_SIZE, BLOCK_SIZE):
+            return
+
+        # Il riuso dei frame è solo un'ottimizzazione: se il file precedente non si riesce
+        # a indicizzare o a decodificare ricodifico tutti i blocchi
+        try:
+            index = build_frame_index(self.input_file, metadata)
+
+            # Se il file non contiene gli hash dei blocchi li ricavo decodificandolo
+            block_hashes = metadata.applications.get(APPLICATION_ID_BLOCK_HASHES)
+            if block_hashes is not None and len(block_hashes) == BLOCK_HASH_SIZE * len(index):
+                block_hashes = [block_hashes[i : i + BLOCK_HASH_SIZE] for i in range(0, len(block_hashes), BLOCK_HASH_SIZE)]
+            else:
+                self.input_file.seek(0)
+                block_hashes = [hash_block(block[:, i] for i in range(block.shape[1]))
+                                for _, block in iter_frames(self.input_file, copy=False)]
+        except (ValueError, EOFError, OverflowError):
+            return
+
+        if len(block_hashes) != len(index):
+            return
+
+        for i, block_hash in enumerate(block_hashes):
+            self.frames.setdefault(block_hash, (index.offsets[i], index.frame_size(i), index.block_sizes[i]))
+
+    def copy_frame(self, block_hash, frame_number, num_samples):
+        if block_hash not in self.frames:
+            return None
+
+        offset, frame_size, block_size = self.frames[block_hash]
+        if block_size != num_samples:
+            return None
+
+        self.input_file.seek(offset)
+        frame_bytes = self.input_file.read(frame_size)
+
+        # L'ultimo frame dell'indice arriva fino a fine file: eventuali byte in coda
+        # (es. tag ID3v1) fanno fallire il CRC-16 e il blocco viene ricodificato
+        if len(frame_bytes) < 2 or crc16(frame_bytes[:-2]) != struct.unpack('>H', frame_bytes[-2:])[0]:
+            return None
+
+        # Copio solo frame a blocksize fisso (il numero nell'header è il numero del frame)
+        header_length, variable, _, _ = parse_frame_header(frame_bytes, 0)
+        if variable:
+            return None
+
+        return CopiedFrame(frame_number, num_samples, frame_bytes, header_length)
+
+    def close(self):
+        self.input_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
 
 class WaveStream:
-    def __init__(self, sample_size, sample_rate, channels, md5_digest):
+    def __init__(self, sample_size, sample_rate, channels, md5_digest, input_file=None):
         self.sample_size = sample_size   
         self.sample_rate = sample_rate      
         self.channels = channels            
         self.num_channels = len(channels)
         self.num_samples = len(channels[0])
         self.md5_digest = md5_digest
+        self.input_file = input_file
+
+    def close(self):
+        # Rilascio le viste numpy sui campioni prima di chiudere il file mappato
+        self.channels = None
+        if self.input_file is not None:
+            self.input_file.close()
+            self.input_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
 
 if __name__ == "__main__":
     main(sys.argv)
\ No newline at end of file
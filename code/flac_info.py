@@ -0,0 +1,386 @@
+import array
+import bisect
+import os
+import re
+import struct
+import sys
+from flac import crc8
+
+# Tipologie di blocco Flac
+BLOCK_TYPE_STREAMINFO = 0
+BLOCK_TYPE_PADDING = 1
+BLOCK_TYPE_APPLICATION = 2
+BLOCK_TYPE_SEEKTABLE = 3
+BLOCK_TYPE_VORBIS_COMMENT = 4
+BLOCK_TYPE_CUESHEET = 5
+BLOCK_TYPE_PICTURE = 6
+
+BLOCK_TYPE_NAMES = {
+    BLOCK_TYPE_STREAMINFO: "STREAMINFO",
+    BLOCK_TYPE_PADDING: "PADDING",
+    BLOCK_TYPE_APPLICATION: "APPLICATION",
+    BLOCK_TYPE_SEEKTABLE: "SEEKTABLE",
+    BLOCK_TYPE_VORBIS_COMMENT: "VORBIS_COMMENT",
+    BLOCK_TYPE_CUESHEET: "CUESHEET",
+    BLOCK_TYPE_PICTURE: "PICTURE",
+}
+
+SEEKPOINT_PLACEHOLDER = 0xFFFFFFFFFFFFFFFF
+
+# Dimensione dei blocchi letti durante la ricerca dei frame
+CHUNK_SIZE = 1 << 20
+# Header di frame più lungo possibile: sync + 2 byte + numero utf-8 (7) + blocksize (2) + samplerate (2) + crc
+MAX_FRAME_HEADER_SIZE = 16
+# 14 bit di sync (0x3FFE) + bit riservato a 0 + blocking strategy
+SYNC_PATTERN = re.compile(b"\xff[\xf8\xf9]")
+
+# Sidecar: magic, versione, numero di frame, offset di fine stream, MD5 di STREAMINFO
+INDEX_MAGIC = b"fLaI"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct("<4sHQQ16s")
+
+def main(argv):
+    # Stampo le informazioni sul file. Se mi viene passato il path del sidecar
+    # riuso l'indice salvato (se si riferisce ancora al file) oppure lo ricostruisco e lo salvo
+    with open(argv[1], "rb") as inp:
+        metadata = read_metadata(inp)
+        if len(argv) > 2:
+            index = load_or_build_frame_index(inp, metadata, argv[1], argv[2])
+        else:
+            index = build_frame_index(inp, metadata)
+
+    print_info(metadata, index)
+
+def load_or_build_frame_index(inp, metadata, input_path, index_path):
+    if os.path.exists(index_path):
+        try:
+            index = load_frame_index(index_path)
+        except (ValueError, EOFError):
+            index = None
+        if index is not None and index.matches(input_path, metadata.stream_info.md5_digest):
+            return index
+
+    index = build_frame_index(inp, metadata)
+    index.save(index_path)
+    return index
+
+def read_metadata(inp):
+    # Leggo il file flac e verifico che i primi 32 bit siano coerenti con il formato flac
+    if inp.read(4) != b"fLaC":
+        raise ValueError("Invalid fLaC file!")
+
+    metadata = Metadata()
+    last = False
+    # Ogni blocco viene letto in un'unica read e poi interpretato in base al tipo
+    while not last:
+        header = inp.read(4)
+        if len(header) != 4:
+            raise EOFError()
+        last = header[0] & 0x80 != 0
+        block_type = header[0] & 0x7F
+        length = int.from_bytes(header[1:4], "big")
+        data = inp.read(length)
+        if len(data) != length:
+            raise EOFError()
+
+        if block_type == BLOCK_TYPE_STREAMINFO:
+            metadata.stream_info = parse_stream_info(data)
+        elif block_type == BLOCK_TYPE_SEEKTABLE:
+            metadata.seek_points = parse_seek_table(data)
+        elif block_type == BLOCK_TYPE_VORBIS_COMMENT:
+            metadata.vendor, metadata.comments = parse_vorbis_comment(data)
+        elif block_type == BLOCK_TYPE_APPLICATION:
+            metadata.applications[data[0:4]] = data[4:]
+        metadata.blocks.append((block_type, length))
+
+    # Verifico che lo stream info sia presente
+    if metadata.stream_info is None:
+        raise ValueError("Stream info metadata block absent!")
+
+    metadata.audio_offset = inp.tell()
+    return metadata
+
+def parse_stream_info(data):
+    if len(data) != 34:
+        raise ValueError("Invalid stream info metadata block!")
+
+    min_block_size, max_block_size = struct.unpack(">HH", data[0:4])
+    min_frame_size = int.from_bytes(data[4:7], "big")
+    max_frame_size = int.from_bytes(data[7:10], "big")
+    # 20 bit samplerate, 3 bit numchannels - 1, 5 bit samplesize - 1, 36 bit numsamples
+    bits = int.from_bytes(data[10:18], "big")
+    sample_rate = bits >> 44
+    num_channels = ((bits >> 41) & 0x7) + 1
+    sample_size = ((bits >> 36) & 0x1F) + 1
+    num_samples = bits & 0xFFFFFFFFF
+
+    return StreamInfo(min_block_size, max_block_size, min_frame_size, max_frame_size,
+                      sample_rate, num_channels, sample_size, num_samples, data[18:34])
+
+def parse_seek_table(data):
+    # Ogni seek point: primo campione (64 bit), offset (64 bit), numero di campioni (16 bit)
+    seek_points = list()
+    for i in range(0, len(data) - 17, 18):
+        sample, offset, num_samples = struct.unpack(">QQH", data[i : i + 18])
+        if sample != SEEKPOINT_PLACEHOLDER:
+            seek_points.append((sample, offset, num_samples))
+    return seek_points
+
+def parse_vorbis_comment(data):
+    # A differenza del resto del formato, le lunghezze qui sono little-endian
+    length, = struct.unpack("<I", data[0:4])
+    vendor = data[4 : 4 + length].decode("utf-8", "replace")
+    pos = 4 + length
+    count, = struct.unpack("<I", data[pos : pos + 4])
+    pos += 4
+
+    comments = list()
+    for _ in range(count):
+        length, = struct.unpack("<I", data[pos : pos + 4])
+        comments.append(data[pos + 4 : pos + 4 + length].decode("utf-8", "replace"))
+        pos += 4 + length
+    return vendor, comments
+
+def parse_frame_header(buf, pos):
+    # Restituisce (lunghezza header, variable blocksize, numero frame/campione, blocksize)
+    # oppure None se in pos non c'è un header di frame valido
+    if pos + 6 > len(buf):
+        return None
+
+    blocksizecode = buf[pos + 2] >> 4
+    sampleratecode = buf[pos + 2] & 0xF
+    chanasgn = buf[pos + 3] >> 4
+    samplesizecode = (buf[pos + 3] >> 1) & 0x7
+
+    # Valori riservati
+    if blocksizecode == 0 or sampleratecode == 15 or chanasgn > 10 or samplesizecode == 3 or buf[pos + 3] & 1:
+        return None
+
+    # Numero di frame (o di campione) codificato in utf-8 "esteso" fino a 7 byte
+    temp = buf[pos + 4]
+    if temp < 0x80:
+        numbytes = 0
+        number = temp
+    elif 0xC0 <= temp < 0xFE:
+        numbytes = 1
+        while temp & (0x40 >> numbytes):
+            numbytes += 1
+        number = temp & (0x3F >> numbytes)
+    elif temp == 0xFE:
+        numbytes = 6
+        number = 0
+    else:
+        return None
+
+    end = pos + 5 + numbytes
+    if end > len(buf):
+        return None
+    for temp in buf[pos + 5 : end]:
+        if temp & 0xC0 != 0x80:
+            return None
+        number = (number << 6) | (temp & 0x3F)
+
+    if blocksizecode == 1:
+        blocksize = 192
+    elif 2 <= blocksizecode <= 5:
+        blocksize = 576 << blocksizecode - 2
+    elif blocksizecode == 6:
+        end += 1
+        blocksize = buf[end - 1] + 1 if end <= len(buf) else 0
+    elif blocksizecode == 7:
+        end += 2
+        blocksize = int.from_bytes(buf[end - 2 : end], "big") + 1 if end <= len(buf) else 0
+    else:
+        blocksize = 256 << (blocksizecode - 8)
+
+    if sampleratecode == 12:
+        end += 1
+    elif sampleratecode in (13, 14):
+        end += 2
+
+    # CRC-8 dell'header
+    if end + 1 > len(buf) or crc8(buf[pos:end]) != buf[end]:
+        return None
+
+    return end + 1 - pos, buf[pos + 1] & 1 == 1, number, blocksize
+
+def build_frame_index(inp, metadata, chunk_size=CHUNK_SIZE):
+    # Cerco il sync code dei frame in blocchi di chunk_size byte senza decodificare i residual.
+    # Un candidato è accettato solo se il CRC-8 dell'header è corretto e il suo primo
+    # campione coincide con quello atteso dopo il frame precedente
+    stream_info = metadata.stream_info
+    index = FrameIndex(stream_info.md5_digest)
+
+    inp.seek(metadata.audio_offset)
+    buf = b""
+    base = metadata.audio_offset
+    search_from = 0
+    expected_sample = 0
+    eof = False
+
+    while not eof:
+        chunk = inp.read(chunk_size)
+        eof = len(chunk) == 0
+        buf = buf + chunk
+
+        # Tengo da parte la coda del buffer: un header potrebbe essere a cavallo di due blocchi
+        limit = len(buf) if eof else max(len(buf) - MAX_FRAME_HEADER_SIZE, 0)
+
+        for match in SYNC_PATTERN.finditer(buf, search_from, limit + 1):
+            pos = match.start()
+            if pos >= limit:
+                break
+            if pos < search_from:
+                continue
+
+            header = parse_frame_header(buf, pos)
+            if header is None:
+                continue
+            header_length, variable, number, blocksize = header
+
+            first_sample = number if variable else number * stream_info.max_block_size
+            if first_sample != expected_sample:
+                continue
+
+            index.append(base + pos, first_sample, blocksize)
+            expected_sample = first_sample + blocksize
+            search_from = pos + header_length
+
+        base += limit
+        search_from = max(search_from - limit, 0)
+        buf = buf[limit:]
+
+    index.end_offset = base + len(buf)
+    return index
+
+def load_frame_index(path):
+    with open(path, "rb") as inp:
+        header = inp.read(INDEX_HEADER.size)
+        if len(header) != INDEX_HEADER.size:
+            raise ValueError("Invalid frame index!")
+        magic, version, num_frames, end_offset, md5_digest = INDEX_HEADER.unpack(header)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError("Invalid frame index!")
+
+        index = FrameIndex(md5_digest)
+        index.end_offset = end_offset
+        index.offsets.fromfile(inp, num_frames)
+        index.first_samples.fromfile(inp, num_frames)
+        index.block_sizes.fromfile(inp, num_frames)
+
+    if sys.byteorder == "big":
+        index.byteswap()
+    return index
+
+def print_info(metadata, index):
+    stream_info = metadata.stream_info
+
+    print("Metadata blocks:")
+    for block_type, length in metadata.blocks:
+        print("  %-16s %d bytes" % (BLOCK_TYPE_NAMES.get(block_type, "RESERVED (%d)" % block_type), length))
+    print("Sample rate:     %d Hz" % stream_info.sample_rate)
+    print("Channels:        %d" % stream_info.num_channels)
+    print("Bits per sample: %d" % stream_info.sample_size)
+    print("Samples:         %d" % stream_info.num_samples)
+    print("Duration:        %.3f s" % stream_info.duration())
+    print("MD5:             %s" % stream_info.md5_digest.hex())
+    if metadata.vendor is not None:
+        print("Vendor:          %s" % metadata.vendor)
+        for comment in metadata.comments:
+            print("  %s" % comment)
+    if metadata.seek_points:
+        print("Seek points:     %d" % len(metadata.seek_points))
+
+    print("Frames:          %d" % len(index))
+    if len(index):
+        frame_sizes = index.frame_sizes()
+        bit_rates = [index.bit_rate(i, stream_info.sample_rate) for i in range(len(index))]
+        print("Frame sizes:     %d - %d bytes" % (min(frame_sizes), max(frame_sizes)))
+        print("Bit rate:        %.1f - %.1f kbit/s (avg %.1f)" % (min(bit_rates) / 1000, max(bit_rates) / 1000,
+              8 * (index.end_offset - index.offsets[0]) / max(stream_info.duration(), 1e-9) / 1000))
+
+class Metadata:
+    def __init__(self):
+        self.blocks = list()
+        self.stream_info = None
+        self.seek_points = list()
+        self.vendor = None
+        self.comments = list()
+        self.applications = dict()
+        self.audio_offset = None
+
+class StreamInfo:
+    def __init__(self, min_block_size, max_block_size, min_frame_size, max_frame_size,
+                 sample_rate, num_channels, sample_size, num_samples, md5_digest):
+        self.min_block_size = min_block_size
+        self.max_block_size = max_block_size
+        self.min_frame_size = min_frame_size
+        self.max_frame_size = max_frame_size
+        self.sample_rate = sample_rate
+        self.num_channels = num_channels
+        self.sample_size = sample_size
+        self.num_samples = num_samples
+        self.md5_digest = md5_digest
+
+    def duration(self):
+        return self.num_samples / self.sample_rate if self.sample_rate else 0.0
+
+class FrameIndex:
+    def __init__(self, md5_digest):
+        self.md5_digest = md5_digest
+        self.end_offset = 0
+        # Array tipizzati: offset in byte del frame, primo campione, numero di campioni
+        self.offsets = array.array("Q")
+        self.first_samples = array.array("Q")
+        self.block_sizes = array.array("I")
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, offset, first_sample, block_size):
+        self.offsets.append(offset)
+        self.first_samples.append(first_sample)
+        self.block_sizes.append(block_size)
+
+    def frame_size(self, i):
+        end = self.offsets[i + 1] if i + 1 < len(self.offsets) else self.end_offset
+        return end - self.offsets[i]
+
+    def frame_sizes(self):
+        return [self.frame_size(i) for i in range(len(self))]
+
+    def bit_rate(self, i, sample_rate):
+        return 8 * self.frame_size(i) * sample_rate / self.block_sizes[i]
+
+    def find(self, sample):
+        # Indice del frame che contiene il campione richiesto
+        i = bisect.bisect_right(self.first_samples, sample) - 1
+        if i < 0 or sample >= self.first_samples[i] + self.block_sizes[i]:
+            raise IndexError("Sample out of range")
+        return i
+
+    def byteswap(self):
+        self.offsets.byteswap()
+        self.first_samples.byteswap()
+        self.block_sizes.byteswap()
+
+    def save(self, path):
+        # Il sidecar è sempre little-endian
+        if sys.byteorder == "big":
+            self.byteswap()
+        try:
+            with open(path, "wb") as out:
+                out.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(self), self.end_offset, self.md5_digest))
+                self.offsets.tofile(out)
+                self.first_samples.tofile(out)
+                self.block_sizes.tofile(out)
+        finally:
+            if sys.byteorder == "big":
+                self.byteswap()
+
+    def matches(self, path, md5_digest):
+        # Verifico che l'indice si riferisca al file (dimensione e MD5 di STREAMINFO)
+        return os.path.getsize(path) == self.end_offset and md5_digest == self.md5_digest
+
+if __name__ == "__main__":
+    main(sys.argv)
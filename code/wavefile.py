@@ -0,0 +1,106 @@
+import hashlib
+import mmap
+import struct
+import numpy as np
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# Nei file RF64/BW64 le dimensioni a 32 bit valgono 0xFFFFFFFF e quelle vere sono nel chunk ds64
+RF64_SIZE_PLACEHOLDER = 0xFFFFFFFF
+
+class WaveFile:
+    # File WAV (RIFF, RF64 o BW64) mappato in memoria: i campioni non vengono mai copiati,
+    # sia l'MD5 sia l'array numpy lavorano direttamente sulla regione mappata
+    def __init__(self, input_path):
+        with open(input_path, 'rb') as input_file:
+            self.map = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Se l'header non è valido non devo lasciare il file mappato
+        try:
+            self.read_chunks()
+        except BaseException:
+            self.map.close()
+            raise
+
+    def read_chunks(self):
+        riff_id, _, wave_id = struct.unpack_from('<4sI4s', self.map, 0)
+        if riff_id not in (b'RIFF', b'RF64', b'BW64') or wave_id != b'WAVE':
+            raise ValueError("Invalid WAV file!")
+
+        fmt = None
+        ds64_data_size = None
+        data_offset = None
+        data_size = None
+
+        # Scorro i chunk fino a trovare sia "fmt " sia "data"
+        pos = 12
+        while pos + 8 <= len(self.map) and (fmt is None or data_offset is None):
+            chunk_id, chunk_size = struct.unpack_from('<4sI', self.map, pos)
+            pos += 8
+
+            if chunk_id == b'ds64':
+                # Dimensione del RIFF (64 bit), dimensione del chunk data (64 bit), ...
+                _, ds64_data_size = struct.unpack_from('<QQ', self.map, pos)
+            elif chunk_id == b'fmt ':
+                fmt = self.map[pos : pos + chunk_size]
+            elif chunk_id == b'data':
+                if chunk_size == RF64_SIZE_PLACEHOLDER and ds64_data_size is not None:
+                    chunk_size = ds64_data_size
+                data_offset = pos
+                # Un chunk data troncato (es. registrazione interrotta) arriva fino a fine file
+                data_size = min(chunk_size, len(self.map) - pos)
+
+            # I chunk sono allineati a 2 byte
+            pos += chunk_size + (chunk_size & 1)
+
+        if fmt is None or data_offset is None:
+            raise ValueError("Missing fmt or data chunk!")
+
+        format_tag, self.num_channels, self.sample_rate, _, block_align, bits_per_sample = struct.unpack_from('<HHIIHH', fmt, 0)
+
+        # WAVE_FORMAT_EXTENSIBLE: cbSize, valid bits, channel mask, GUID del sottoformato (i primi 2 byte sono il tag)
+        if format_tag == WAVE_FORMAT_EXTENSIBLE:
+            if len(fmt) < 40:
+                raise ValueError("Invalid WAVE_FORMAT_EXTENSIBLE header!")
+            format_tag, = struct.unpack_from('<H', fmt, 24)
+
+        if format_tag != WAVE_FORMAT_PCM:
+            raise ValueError("Only PCM WAV files are supported!")
+        if bits_per_sample % 8 != 0 or block_align != self.num_channels * bits_per_sample // 8:
+            raise ValueError("Sample size not supported!")
+
+        self.sample_size = bits_per_sample
+        self.block_align = block_align
+        self.num_samples = data_size // block_align
+        self.data_offset = data_offset
+        self.data_size = self.num_samples * block_align
+
+    def get_data(self):
+        # Vista (senza copia) sui byte dei campioni
+        return memoryview(self.map)[self.data_offset : self.data_offset + self.data_size]
+
+    def get_samples(self):
+        # Matrice [numsamples, numchannels] sulla regione mappata (solo 16 bit)
+        if self.sample_size != 16:
+            raise ValueError("Sample size not supported!")
+
+        return np.frombuffer(self.map, dtype='<i2', count=self.num_samples * self.num_channels,
+                             offset=self.data_offset).reshape(self.num_samples, self.num_channels)
+
+    def get_md5_digest(self):
+        md5 = hashlib.md5()
+        with self.get_data() as data:
+            md5.update(data)
+        return md5.digest()
+
+    def close(self):
+        # Le viste ottenute da get_data/get_samples vanno rilasciate prima:
+        # finché ne esiste una la mappa non si può chiudere (BufferError)
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()